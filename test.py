@@ -1,5 +1,6 @@
 import awkward as ak
 from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+from coffea.nanoevents.methods.nanoaod import GenParticle
 import hist
 import pickle
 import uproot
@@ -8,9 +9,9 @@ from coffea.analysis_tools import PackedSelection
 from coffea import processor
 import matplotlib.pyplot as plt
 import numpy as np
-import itertools
-from coffea.processor import accumulate
 from dask.distributed import Client
+from dask_jobqueue import HTCondorCluster
+from numba import njit, prange
 
 
 def is_rootcompat(a):
@@ -26,20 +27,33 @@ def is_rootcompat(a):
     return False
 
 
+_compat_fields_cache = {}
+
+
+def compat_fields(branch, bname):
+    """Names of the fields of a branch that uproot can write, cached per layout"""
+    key = (bname, tuple(branch.fields))
+    if key not in _compat_fields_cache:
+        _compat_fields_cache[key] = tuple(
+            n for n in branch.fields if is_rootcompat(branch[n])
+        )
+    return _compat_fields_cache[key]
+
+
 def uproot_writeable(events):
     """Restrict to columns that uproot can write compactly"""
     out = {}
     for bname in events.fields:
-        if events[bname].fields:
+        branch = events[bname]
+        if branch.fields:
             out[bname] = ak.zip(
                 {
-                    n: ak.packed(ak.without_parameters(events[bname][n]))
-                    for n in events[bname].fields
-                    if is_rootcompat(events[bname][n])
+                    n: ak.packed(ak.without_parameters(branch[n]))
+                    for n in compat_fields(branch, bname)
                 }
             )
         else:
-            out[bname] = ak.packed(ak.without_parameters(events[bname]))
+            out[bname] = ak.packed(ak.without_parameters(branch))
     return out
 
 
@@ -56,125 +70,263 @@ nj_axis = hist.axis.Regular(10, 0, 10, name="nj", label=r"$n_{j}$")
 b_axis = hist.axis.Regular(5, 0, 5, name="nb", label=r"$n_{b}$")
 
 
+def padded(array, n, fill=0):
+    """Dense (events, n) numpy copy of the first n entries of a jagged array"""
+    return ak.to_numpy(ak.fill_none(ak.pad_none(array, n, clip=True), fill))
+
+
+@njit(parallel=True)
+def cutSetKernel(flat, wps):
+    out = np.empty((len(wps), len(flat)), dtype=np.bool_)
+    for i in prange(len(flat)):
+        v = flat[i]
+        for w in range(len(wps)):
+            out[w, i] = v > wps[w]
+    return out
+
+
 def makeCutSet(x, s, *args):
-    return [x[s > a] for a in args]
+    counts = ak.num(s)
+    passed = cutSetKernel(
+        ak.to_numpy(ak.flatten(s)), np.asarray(args, dtype=np.float64)
+    )
+    return [x[ak.unflatten(p, counts)] for p in passed]
+
+
+LAST_COPY = 1 << GenParticle.FLAGS.index("isLastCopy")
+FROM_HARD = 1 << GenParticle.FLAGS.index("fromHardProcess")
+FROM_HARD_BEFORE_FSR = 1 << GenParticle.FLAGS.index("fromHardProcessBeforeFSR")
+
+
+@njit(parallel=True)
+def goodGenParticleKernel(flags, pdg, out):
+    for i in prange(len(flags)):
+        last_hard = (flags[i] & LAST_COPY != 0) and (flags[i] & FROM_HARD != 0)
+        before_fsr = flags[i] & FROM_HARD_BEFORE_FSR != 0
+        ap = abs(pdg[i])
+        out[i] = last_hard and not (before_fsr and (ap == 1 or ap == 3))
 
 
 def isGoodGenParticle(particle):
-    return particle.hasFlags("isLastCopy", "fromHardProcess") & ~(
-        particle.hasFlags("fromHardProcessBeforeFSR")
-        & ((abs(particle.pdgId) == 1) | (abs(particle.pdgId) == 3))
-    )
+    flags = ak.to_numpy(ak.flatten(particle.statusFlags))
+    pdg = ak.to_numpy(ak.flatten(particle.pdgId))
+    out = np.empty(len(flags), dtype=np.bool_)
+    goodGenParticleKernel(flags, pdg, out)
+    return ak.unflatten(out, ak.num(particle))
+
 
+B_TAG_WPS = {
+    "UL2016preVFP": np.array([0.0508, 0.2598, 0.6502]),
+    "UL2016postVFP": np.array([0.0480, 0.2489, 0.6377]),
+    "UL2017": np.array([0.0532, 0.3040, 0.7476]),
+    "UL2018": np.array([0.0490, 0.2783, 0.7100]),
+}
 
 MCCampaign = "UL2018"
-if MCCampaign == "UL2016preVFP":
-    b_tag_wps = [0.0508, 0.2598, 0.6502]
-elif MCCampaign == "UL2016postVFP":
-    b_tag_wps = [0.0480, 0.2489, 0.6377]
-elif MCCampaign == "UL2017":
-    b_tag_wps = [0.0532, 0.3040, 0.7476]
-elif MCCampaign == "UL2018":
-    b_tag_wps = [0.0490, 0.2783, 0.7100]
+b_tag_wps = B_TAG_WPS[MCCampaign]
 
 
 def createObjects(events):
-    good_jets = events.Jet[(events.Jet.pt > 30) & (abs(events.Jet.eta) < 2.4)]
+    j = events.Jet
+    jet_mask = (j.pt > 30) & (abs(j.eta) < 2.4)
+    good_jets = j[jet_mask]
     fat_jets = events.FatJet
-    (tight_top,) = makeCutSet(fat_jets, fat_jets.particleNet_TvsQCD, 0.97)
-    loose_b, med_b = makeCutSet(
-        good_jets, good_jets.btagDeepFlavB, b_tag_wps[0], b_tag_wps[1]
-    )
+    loose_b, med_b = makeCutSet(good_jets, good_jets.btagDeepFlavB, *b_tag_wps[:2])
     el = events.Electron
-    good_electrons = el[
+    el_mask = (
         (el.cutBased == 4)
         & (el.miniPFRelIso_all < 0.1)
         & (el.pt > 30)
         & (abs(el.eta) < 2.4)
-    ]
+    )
+    good_electrons = el[el_mask]
     mu = events.Muon
-    good_muons = mu[
+    mu_mask = (
         (mu.mediumId) & (mu.miniPFRelIso_all < 0.2) & (mu.pt > 30) & (abs(mu.eta) < 2.4)
-    ]
-    events["good_jets"] = good_jets
-    events["good_electrons"] = good_electrons
-    events["good_muons"] = good_muons
-    events["loose_bs"] = loose_b
-    events["med_bs"] = med_b
-    events["tight_tops"] = tight_top
-    return events, {}
-
-
-def goodGenParticles(events):
-    events["good_gen_particles"] = events.GenPart[isGoodGenParticle(events.GenPart)]
-    gg = events.good_gen_particles
+    )
+    good_muons = mu[mu_mask]
+    objects = {
+        "good_jets": good_jets,
+        "fat_jets": fat_jets,
+        "good_electrons": good_electrons,
+        "good_muons": good_muons,
+        "loose_bs": loose_b,
+        "med_bs": med_b,
+    }
+    return events, objects
+
+
+def goodGenParticles(events, objects):
+    gen = events.GenPart
+    gg = gen[isGoodGenParticle(gen)]
     top = gg[abs(gg.pdgId) == 1000006]
-    return events
+    objects["good_gen_particles"] = gg
+    return events, objects
 
 
-def createSelection(events):
-    good_jets = events.good_jets
-    fat_jets = events.FatJet
+def createSelection(events, objects):
+    good_jets = objects["good_jets"]
 
-    good_muons = events.good_muons
-    good_electrons = events.good_electrons
+    good_muons = objects["good_muons"]
+    good_electrons = objects["good_electrons"]
 
-    loose_b = events.loose_bs
-    tight_top = events.tight_tops
+    loose_b = objects["loose_bs"]
+    fat_jets = objects["fat_jets"]
 
     selection = PackedSelection()
 
-    filled_jets = ak.pad_none(good_jets, 2, axis=1)
-    # filled_jets = good_jets
-    top_two_dr = ak.fill_none(filled_jets[:, 0].delta_r(filled_jets[:, 1]), False)
+    njets = ak.to_numpy(ak.num(good_jets))
+    has1, has2 = njets >= 1, njets >= 2
+    lead_pt = np.zeros(len(njets))
+    lead_pt[has1] = ak.to_numpy(good_jets[has1][:, 0].pt)
+    two_jets = good_jets[has2]
+    top_two_dr = np.zeros(len(njets))
+    top_two_dr[has2] = ak.to_numpy(two_jets[:, 0].delta_r(two_jets[:, 1]))
 
-    selection.add("jets", (ak.num(good_jets) >= 4) & (ak.num(good_jets) <= 5))
+    selection.add("jets", (njets >= 4) & (njets <= 5))
     selection.add("0Lep", (ak.num(good_electrons) == 0) & (ak.num(good_muons) == 0))
     selection.add("2bjet", ak.num(loose_b) >= 2)
-    selection.add("highptjet", ak.fill_none(filled_jets[:, 0].pt > 300, False))
-    selection.add("jet_dr", (top_two_dr < 4) & (top_two_dr > 2))
-    selection.add("0Top", ak.num(tight_top) == 0)
+    selection.add("highptjet", lead_pt > 300)
+    selection.add("jet_dr", has2 & (top_two_dr < 4) & (top_two_dr > 2))
+    n_tight_top = ak.sum(fat_jets.particleNet_TvsQCD > 0.97, axis=1)
+    selection.add("0Top", n_tight_top == 0)
     return selection
 
 
-def makeHistogram(axis, dataset, data):
-    h = hist.Hist(dataset_axis, axis, storage="weight")
-    return h.fill(dataset, data)
+@njit
+def regularCountsKernel(values, starts, lows, highs, nbins, closed, out, out_starts):
+    for h in range(len(nbins)):
+        lo, width, nb = lows[h], highs[h] - lows[h], nbins[h]
+        o = out_starts[h]
+        for i in range(starts[h], starts[h + 1]):
+            z = (values[i] - lo) / width
+            if z < 0:
+                out[o] += 1
+            elif z < 1:
+                out[o + 1 + int(z * nb)] += 1
+            elif z == 1 and closed[h]:
+                out[o + nb] += 1
+            else:
+                out[o + nb + 1] += 1
+
+
+def regularCounts(axes, data):
+    """Unweighted counts of each data array on its regular axis, including flow bins
+
+    As in boost-histogram, an axis without an overflow bin includes its upper edge
+    in the last bin.
+    """
+    values = [np.asarray(d, dtype=np.float64).ravel() for d in data]
+    starts = np.cumsum([0] + [len(v) for v in values])
+    nbins = np.array([axis.size for axis in axes])
+    out_starts = np.cumsum(np.concatenate([[0], nbins + 2]))
+    out = np.zeros(out_starts[-1])
+    regularCountsKernel(
+        np.concatenate(values),
+        starts,
+        np.array([axis.edges[0] for axis in axes]),
+        np.array([axis.edges[-1] for axis in axes]),
+        nbins,
+        np.array([not axis.traits.overflow for axis in axes]),
+        out,
+        out_starts,
+    )
+    ret = []
+    for axis, o, nb in zip(axes, out_starts, nbins):
+        counts = out[o : o + nb + 2]
+        if not axis.traits.underflow:
+            counts = counts[1:]
+        if not axis.traits.overflow:
+            counts = counts[:-1]
+        ret.append(counts)
+    return ret
 
 
-def createJetHistograms(events):
+def integerCounts(axis, values):
+    """Unweighted counts of non-negative integers on unit-width bins starting at 0"""
+    binned = np.bincount(values, minlength=axis.size)
+    counts = [binned[: axis.size]]
+    if axis.traits.underflow:
+        counts.insert(0, [0])
+    if axis.traits.overflow:
+        counts.append([binned[axis.size :].sum()])
+    return np.concatenate(counts)
+
+
+def fillCounts(axis, dataset, counts):
+    h = hist.Hist(
+        hist.axis.StrCategory(
+            [dataset], growth=True, name=dataset_axis.name, label=dataset_axis.label
+        ),
+        axis,
+        storage="weight",
+    )
+    view = h.view(flow=True)[0]
+    view.value += counts
+    view.variance += counts
+    return h
+
+
+def makeHistograms(dataset, fills):
+    """Histograms for {name: (axis, data)}, binning regular axes in one kernel call"""
     ret = {}
+    regular = {}
+    for name, (axis, data) in fills.items():
+        if isinstance(axis, hist.axis.Regular):
+            regular[name] = (axis, data)
+        else:
+            h = hist.Hist(dataset_axis, axis, storage="weight")
+            ret[name] = h.fill(dataset, data)
+    if regular:
+        axes, data = zip(*regular.values())
+        for name, axis, counts in zip(regular, axes, regularCounts(axes, data)):
+            ret[name] = fillCounts(axis, dataset, counts)
+    return {name: ret[name] for name in fills}
+
+
+def makeCountHistogram(axis, dataset, data):
+    counts = integerCounts(axis, ak.to_numpy(data))
+    return fillCounts(axis, dataset, counts)
+
+
+def createJetHistograms(events, objects):
+    fills = {}
     dataset = events.metadata["dataset"]
-    gj = events.good_jets
+    gj = objects["good_jets"]
 
-    ret[f"h_jet_pt"] = makeHistogram(phi_axis, dataset, ak.flatten(gj.pt))
-    ret[f"h_njet"] = makeHistogram(nj_axis, dataset, ak.num(gj))
+    fills[f"h_jet_pt"] = (phi_axis, ak.flatten(gj.pt))
 
+    px, py, pz, e = (padded(c, 4) for c in (gj.x, gj.y, gj.z, gj.t))
     for i, j in [(0, 3), (1, 4), (0, 4)]:
-        jets = gj[:, i:j].sum()
-        ret[f"h_m{i}{j}_pt"] = makeHistogram(pt_axis, dataset, jets.pt)
-        ret[f"h_m{i}{j}_eta"] = makeHistogram(eta_axis, dataset, jets.eta)
-        ret[f"h_m{i}{j}_m"] = makeHistogram(eta_axis, dataset, jets.mass)
+        x, y, z, t = (c[:, i:j].sum(axis=1) for c in (px, py, pz, e))
+        pt = np.hypot(x, y)
+        fills[f"h_m{i}{j}_pt"] = (pt_axis, pt)
+        fills[f"h_m{i}{j}_eta"] = (eta_axis, np.arcsinh(z / pt))
+        fills[f"h_m{i}{j}_m"] = (eta_axis, np.sqrt(t**2 - x**2 - y**2 - z**2))
+    pt4, eta4, phi4 = (padded(c, 4, np.nan) for c in (gj.pt, gj.eta, gj.phi))
+    has_jet = ~np.isnan(pt4)
     for i in range(0, 4):
-        ret[f"h_pt_{i}"] = makeHistogram(pt_axis, dataset, gj[:, i].pt)
-        ret[f"h_eta_{i}"] = makeHistogram(eta_axis, dataset, gj[:, i].eta)
-        ret[f"h_phi_{i}"] = makeHistogram(phi_axis, dataset, gj[:, i].phi)
+        present = has_jet[:, i]
+        fills[f"h_pt_{i}"] = (pt_axis, pt4[present, i])
+        fills[f"h_eta_{i}"] = (eta_axis, eta4[present, i])
+        fills[f"h_phi_{i}"] = (phi_axis, phi4[present, i])
 
-    for i, j in list(x for x in itertools.combinations(range(0, 4), 2) if x[0] != x[1]):
-        pass
+    ret = makeHistograms(dataset, fills)
+    ret[f"h_njet"] = makeCountHistogram(nj_axis, dataset, ak.num(gj))
     return ret
 
 
-def createBHistograms(events):
-    ret = {}
+def createBHistograms(events, objects):
+    fills = {}
     dataset = events.metadata["dataset"]
-    l_bjets = events.loose_bs
-    m_bjets = events.med_bs
-    ret[f"h_loose_bjet_pt"] = makeHistogram(pt_axis, dataset, ak.flatten(l_bjets.pt))
-    ret[f"h_loose_nb"] = makeHistogram(b_axis, dataset, ak.num(l_bjets.pt))
-    ret[f"h_loose_bdr"] = makeHistogram(
-        b_axis, dataset, l_bjets[:, 0].delta_r(l_bjets[:, 1])
-    )
+    l_bjets = objects["loose_bs"]
+    fills[f"h_loose_bjet_pt"] = (pt_axis, ak.flatten(l_bjets.pt))
+    eta2, phi2 = (padded(c, 2, np.nan) for c in (l_bjets.eta, l_bjets.phi))
+    dphi = (phi2[:, 0] - phi2[:, 1] + np.pi) % (2 * np.pi) - np.pi
+    fills[f"h_loose_bdr"] = (b_axis, np.hypot(eta2[:, 0] - eta2[:, 1], dphi))
+
+    ret = makeHistograms(dataset, fills)
+    ret[f"h_loose_nb"] = makeCountHistogram(b_axis, dataset, ak.num(l_bjets))
     return ret
 
 
@@ -182,44 +334,24 @@ def signalGenLevel(events):
     pass
 
 
-def run(events):
-    events, accum = createObjects(events)
-    selection = createSelection(events)
-    events = events[selection.all(*selection.names)]
-
-    good_jets = events.good_jets
-    good_muons = events.good_muons
-    good_electrons = events.good_electrons
-    fat_jets = events.FatJet
+HISTOGRAM_OBJECTS = ("good_jets", "loose_bs")
 
-    loose_top, med_top, tight_top = makeCutSet(
-        fat_jets, fat_jets.particleNet_TvsQCD, 0.58, 0.80, 0.97
-    )
-    loose_W, med_W, tight_W = makeCutSet(
-        fat_jets, fat_jets.particleNet_WvsQCD, 0.7, 0.94, 0.98
-    )
 
-    deep_top_wp1, deep_top_wp2, deep_top_wp3, deep_top_wp4 = makeCutSet(
-        fat_jets, fat_jets.deepTag_TvsQCD, 0.436, 0.802, 0.922, 0.989
-    )
-    deep_W_wp1, deep_W_wp2, deep_W_wp3, deep_W_wp4 = makeCutSet(
-        fat_jets, fat_jets.deepTag_WvsQCD, 0.458, 0.762, 0.918, 0.961
-    )
-    loose_b, med_b, tight_b = makeCutSet(
-        good_jets, good_jets.btagDeepFlavB, *(b_tag_wps[x] for x in range(3))
-    )
+def selectObjects(objects, mask, names=HISTOGRAM_OBJECTS):
+    """Apply the event mask to only the named objects"""
+    return {name: objects[name][mask] for name in names}
 
-    njets = ak.num(good_jets)
-    n_loose_top, n_med_top, n_tight_top = (
-        ak.num(loose_top),
-        ak.num(med_top),
-        ak.num(tight_top),
-    )
-    n_loose_W, n_med_W, n_tight_W = ak.num(loose_W), ak.num(med_W), ak.num(tight_W)
 
-    ht = ak.sum(good_jets.pt, axis=1)
-    ret = createJetHistograms(events)
-    ret = createBHistograms(events)
+def run(events):
+    events, objects = createObjects(events)
+    selection = createSelection(events, objects)
+    mask = selection.all(*selection.names)
+    objects = selectObjects(objects, mask)
+
+    ret = {
+        **createJetHistograms(events, objects),
+        **createBHistograms(events, objects),
+    }
     print(ret)
 
 
@@ -243,28 +375,30 @@ class RPVProcessor(processor.ProcessorABC):
         if not path.is_dir():
             path.mkdir()
         outpath = path / filename
-        with uproot.recreate(outpath) as fout:
+        with uproot.recreate(outpath, compression=uproot.ZSTD(1)) as fout:
             fout["Events"] = uproot_writeable(events)
 
     def process(self, events):
         # print(events.metadata)
         # self.save_skim(events)
         # return [events.metadata]
-        events, accum = createObjects(events)
-        selection = createSelection(events)
-        events = events[selection.all(*selection.names)]
+        events, objects = createObjects(events)
+        selection = createSelection(events, objects)
+        mask = selection.all(*selection.names)
+        objects = selectObjects(objects, mask)
 
-        jet_hists = createJetHistograms(events)
-        b_hists = createBHistograms(events)
+        jet_hists = createJetHistograms(events, objects)
+        b_hists = createBHistograms(events, objects)
 
-        return accumulate([jet_hists, b_hists])
+        out = jet_hists
+        out.update(b_hists)
+        return out
 
     def postprocess(self, accumulator):
         pass
 
 
 if __name__ == "__main__":
-    # cluster = HTCondorCluster(cores=2,memory="2GB",disk="4GB", log_directory="logs",silence_logs='debug')
     fbase = Path("samples")
     samples = [
         ("QCD2018", "QCDBEnriched2018.txt"),
@@ -287,13 +421,22 @@ if __name__ == "__main__":
     #                    ).events()
     #p = RPVProcessor()
     #x = p.process(events)
-    #client = Client()
-    #executor=processor.DaskExecutor(client=client)
-    executor = processor.FuturesExecutor(compression=None, workers=4)
+    cluster = HTCondorCluster(
+        cores=4,
+        memory="8GB",
+        disk="10GB",
+        # one worker process per core, so keep each one's numba kernels to one thread
+        job_script_prologue=["export NUMBA_NUM_THREADS=1"],
+    )
+    cluster.adapt(minimum=10, maximum=100)
+    client = Client(cluster)
+    executor = processor.DaskExecutor(client=client, status=True)
     run = processor.Runner(
-       executor=executor,
-       schema=NanoAODSchema,
-       chunksize=1000000,
+        executor=executor,
+        schema=NanoAODSchema,
+        chunksize=1000000,
+        maxchunks=None,
+        skipbadfiles=True,
     )
     output = run(filesets, "Events", processor_instance=RPVProcessor())
     with open("output.pkl", "wb") as f: